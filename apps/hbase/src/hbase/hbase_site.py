@@ -19,6 +19,7 @@ import errno
 import logging
 import os.path
 import sys
+import time
 
 from hadoop import confparse
 from desktop.lib.security_util import get_components
@@ -33,6 +34,11 @@ LOG = logging.getLogger()
 
 SITE_PATH = None
 SITE_DICT = None
+SITE_KEY = None
+SITE_CHECKED = 0
+
+# hbase-site.xml is stat'ed at most once per interval, in seconds
+SITE_CHECK_INTERVAL = 10
 
 _CNF_HBASE_THRIFT_KERBEROS_PRINCIPAL = 'hbase.thrift.kerberos.principal'
 _CNF_HBASE_THRIFT_SPNEGO_PRINCIPAL = 'hbase.thrift.spnego.principal'
@@ -47,18 +53,32 @@ _CNF_HBASE_USE_THRIFT_SSL = 'hbase.thrift.ssl.enabled'
 
 def reset():
   global SITE_DICT
+  global SITE_KEY
+  global SITE_CHECKED
   SITE_DICT = None
+  SITE_KEY = None
+  SITE_CHECKED = 0
 
 
 def get_conf():
+  global SITE_CHECKED
+
+  # Parsed once, then again only if hbase-site.xml or HBASE_CONF_DIR changes.
   if SITE_DICT is None:
     _parse_site()
+  else:
+    now = time.monotonic()
+    if now - SITE_CHECKED >= SITE_CHECK_INTERVAL:
+      SITE_CHECKED = now
+      if _get_site_key(_get_site_path()) != SITE_KEY:
+        _parse_site()
   return SITE_DICT
 
 
 def get_server_principal():
-  thrift_principal = get_conf().get(_CNF_HBASE_THRIFT_KERBEROS_PRINCIPAL, None)
-  principal = get_conf().get(_CNF_HBASE_THRIFT_SPNEGO_PRINCIPAL, thrift_principal)
+  conf = get_conf()
+  thrift_principal = conf.get(_CNF_HBASE_THRIFT_KERBEROS_PRINCIPAL, None)
+  principal = conf.get(_CNF_HBASE_THRIFT_SPNEGO_PRINCIPAL, thrift_principal)
   components = get_components(principal)
   if components is not None:
     return components[0]
@@ -93,20 +113,35 @@ def is_using_thrift_ssl():
   return get_conf().get(_CNF_HBASE_USE_THRIFT_SSL, 'FALSE').upper() == 'TRUE'
 
 
+def _get_site_path():
+  #Avoid circular import
+  from hbase.conf import HBASE_CONF_DIR
+  return os.path.join(HBASE_CONF_DIR.get(), 'hbase-site.xml')
+
+
+def _get_site_key(path):
+  try:
+    return path, os.stat(path).st_mtime_ns
+  except OSError:
+    return path, None
+
+
 def _parse_site():
   global SITE_DICT
   global SITE_PATH
+  global SITE_KEY
+  global SITE_CHECKED
 
-  #Avoid circular import
-  from hbase.conf import HBASE_CONF_DIR
-  SITE_PATH = os.path.join(HBASE_CONF_DIR.get(), 'hbase-site.xml')
+  SITE_PATH = _get_site_path()
+  SITE_KEY = _get_site_key(SITE_PATH)
+  SITE_CHECKED = time.monotonic()
   try:
-    data = open_file(SITE_PATH, 'r').read()
+    # Let expat read the file in chunks instead of loading it into a string first.
+    with open_file(SITE_PATH, 'rb') as site:
+      SITE_DICT = confparse.ConfParse(site)
   except IOError as err:
     if err.errno != errno.ENOENT:
       LOG.error('Cannot read from "%s": %s' % (SITE_PATH, err))
       return
-    data = ""
-
-  SITE_DICT = confparse.ConfParse(data)
+    SITE_DICT = confparse.ConfParse("")
 
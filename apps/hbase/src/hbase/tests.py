@@ -15,14 +15,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from builtins import object
 import json
-import os
 import shutil
-import sys
-import tempfile
 import pytest
 
+from pathlib import Path
+
 from django.urls import reverse
 from django.test import TestCase
 
@@ -33,21 +31,30 @@ from useradmin.models import User
 
 from hbase.api import HbaseApi
 from hbase.conf import HBASE_CONF_DIR
-from hbase.hbase_site import get_server_authentication, get_server_principal, get_conf, reset, _CNF_HBASE_IMPERSONATION_ENABLED, is_impersonation_enabled
+from hbase.hbase_site import get_server_authentication, get_server_principal, get_conf, reset, _CNF_HBASE_IMPERSONATION_ENABLED
+
+
+@pytest.fixture(scope='module')
+def hbase_conf_dirs(tmp_path_factory):
+  """
+  Writes the hbase-site.xml of each tested authentication once for the whole module.
+  """
+  conf_dirs = {}
+  for name, xml in (('plain', hbase_site_xml()), ('kerberos', hbase_site_xml(authentication='kerberos'))):
+    conf_dir = str(tmp_path_factory.mktemp('hbase_conf_' + name))
+    Path(conf_dir, 'hbase-site.xml').write_text(xml)
+    conf_dirs[name] = conf_dir
 
-if sys.version_info[0] > 2:
-  open_file = open
-else:
-  open_file = file
+  yield conf_dirs
 
+  for conf_dir in conf_dirs.values():
+    shutil.rmtree(conf_dir, ignore_errors=True)
 
-def test_security_plain():
-  tmpdir = tempfile.mkdtemp()
-  finish = HBASE_CONF_DIR.set_for_testing(tmpdir)
+
+def test_security_plain(hbase_conf_dirs):
+  finish = HBASE_CONF_DIR.set_for_testing(hbase_conf_dirs['plain'])
 
   try:
-    xml = hbase_site_xml()
-    open_file(os.path.join(tmpdir, 'hbase-site.xml'), 'w').write(xml)
     reset()
 
     assert 'NOSASL' == get_server_authentication()
@@ -60,16 +67,12 @@ def test_security_plain():
   finally:
     reset()
     finish()
-    shutil.rmtree(tmpdir)
 
 
-def test_security_kerberos():
-  tmpdir = tempfile.mkdtemp()
-  finish = HBASE_CONF_DIR.set_for_testing(tmpdir)
+def test_security_kerberos(hbase_conf_dirs):
+  finish = HBASE_CONF_DIR.set_for_testing(hbase_conf_dirs['kerberos'])
 
   try:
-    xml = hbase_site_xml(authentication='kerberos')
-    open_file(os.path.join(tmpdir, 'hbase-site.xml'), 'w').write(xml)
     reset()
 
     assert 'KERBEROS' == get_server_authentication()
@@ -82,7 +85,6 @@ def test_security_kerberos():
   finally:
     reset()
     finish()
-    shutil.rmtree(tmpdir)
 
 
 def hbase_site_xml(
@@ -114,54 +116,56 @@ def test_impersonation_is_decorator_is_there():
   from hbased.Hbase import do_as
 
 @pytest.mark.django_db
-def test_impersonation():
-  from hbased import Hbase as thrift_hbase
+class TestImpersonation:
 
-  c = make_logged_in_client(username='test_hbase', is_superuser=False)
-  grant_access('test_hbase', 'test_hbase', 'hbase')
-  user = User.objects.get(username='test_hbase')
+  def setup_method(self):
+    from hbased import Hbase as thrift_hbase
 
-  proto = MockProtocol()
-  client = thrift_hbase.Client(proto)
+    make_logged_in_client(username='test_hbase', is_superuser=False)
+    grant_access('test_hbase', 'test_hbase', 'hbase')
+    self.user = User.objects.get(username='test_hbase')
 
-  impersonation_enabled = is_impersonation_enabled()
+    self.proto = MockProtocol()
+    self.thrift_client = thrift_hbase.Client(self.proto)
 
-  get_conf()[_CNF_HBASE_IMPERSONATION_ENABLED] = 'FALSE'
-  try:
-    client.getTableNames(doas=user.username)
-  except AttributeError:
-    pass # We don't mock everything
-  finally:
-    get_conf()[_CNF_HBASE_IMPERSONATION_ENABLED] = impersonation_enabled
-
-  assert {} == proto.get_headers()
+  def _get_table_names(self, impersonation_enabled):
+    conf = get_conf()
+    previous = conf.get(_CNF_HBASE_IMPERSONATION_ENABLED)
 
+    conf[_CNF_HBASE_IMPERSONATION_ENABLED] = impersonation_enabled
+    try:
+      self.thrift_client.getTableNames(doas=self.user.username)
+    except AttributeError:
+      pass # We don't mock everything
+    finally:
+      if previous is None:
+        conf.pop(_CNF_HBASE_IMPERSONATION_ENABLED, None)
+      else:
+        conf[_CNF_HBASE_IMPERSONATION_ENABLED] = previous
 
-  get_conf()[_CNF_HBASE_IMPERSONATION_ENABLED] = 'TRUE'
+  def test_impersonation(self):
+    # A single test so that the user and its grants are only created once
+    self._get_table_names('FALSE')
 
-  try:
-    client.getTableNames(doas=user.username)
-  except AttributeError:
-    pass # We don't mock everything
-  finally:
-    get_conf()[_CNF_HBASE_IMPERSONATION_ENABLED] = impersonation_enabled
+    assert {} == self.proto.get_headers()
 
-  assert {'doAs': u'test_hbase'} == proto.get_headers()
+    self._get_table_names('TRUE')
 
+    assert {'doAs': u'test_hbase'} == self.proto.get_headers()
 
 
-class MockHttpClient(object):
+class MockHttpClient:
   def __init__(self):
     self.headers = {}
 
   def setCustomHeaders(self, headers):
     self.headers = headers
 
-class MockTransport(object):
+class MockTransport:
   def __init__(self):
     self._TBufferedTransport__trans = MockHttpClient()
 
-class MockProtocol(object):
+class MockProtocol:
   def __init__(self):
     self.trans = MockTransport()
 
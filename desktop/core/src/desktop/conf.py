@@ -758,6 +758,9 @@ def is_gunicorn_report_enabled():
     and METRICS.LOCATION.get() is not None \
     and METRICS.COLLECTION_INTERVAL.get() is not None
 
+def get_gunicorn_number_of_workers():
+  return GUNICORN_NUMBER_OF_WORKERS.get() if GUNICORN_NUMBER_OF_WORKERS.get() is not None else 5
+
 SLACK = ConfigSection(
   key='slack',
   help=_("""Configuration options for slack """),
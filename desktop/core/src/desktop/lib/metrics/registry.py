@@ -18,16 +18,19 @@
 All Hue metrics should be defined in the APP/metrics.py file so they are discoverable.
 """
 
-from builtins import object
+import atexit
 import functools
-import pyformance
 import logging
 import os
-
-from multiprocessing import Manager
+import threading
+import time
 
 LOG = logging.getLogger()
 
+# Scrapes and the middleware tolerate this much staleness, in seconds, in exchange for not
+# re-dumping every metric on each call.
+DUMP_METRICS_TTL = 0.25
+
 MAX_LABEL_SUFFIX = ': Max'
 MAX_DESCRIPTION_SUFFIX = ': Max. This is computed over the lifetime of the process.'
 
@@ -79,168 +82,365 @@ AUTH_LDAP_AUTH_TIME_KEY = 'auth.ldap.auth-time'
 AUTH_PAM_AUTH_TIME_KEY = 'auth.pam.auth-time'
 AUTH_SPNEGO_AUTH_TIME_KEY = 'auth.spnego.auth-time'
 
-class MetricsRegistry(object):
-  def __init__(self, registry=None):
-    import sys
+# Fields of a timer dump that get aggregated across Gunicorn workers, in column order. The median is not
+# aggregated and keeps the value of the reporting process.
+TIME_SERIES_FIELDS = (
+  'avg',
+  'sum',
+  'count',
+  'max',
+  'min',
+  'std_dev',
+  '15m_rate',
+  '5m_rate',
+  '1m_rate',
+  'mean_rate',
+  '75_percentile',
+  '95_percentile',
+  '99_percentile',
+  '999_percentile',
+)
+_TIME_SERIES_COUNT_INDEX = TIME_SERIES_FIELDS.index('count')
+
+# Metrics that Gunicorn workers publish to the main process through WorkerMetricsSlots.
+MAX_WORKERS = 64
+WORKER_METRICS_FLUSH_INTERVAL = 1.0
+SHARED_COUNT_KEYS = (
+  REQUESTS_ACTIVE_KEY,
+  REQUESTS_EXCEPTIONS_KEY,
+)
+SHARED_TIME_SERIES_KEYS = (
+  REQUESTS_RESPONSE_TIME_KEY,
+  AUTH_OAUTH_AUTH_TIME_KEY,
+  AUTH_SAML2_AUTH_TIME_KEY,
+  AUTH_LDAP_AUTH_TIME_KEY,
+  AUTH_PAM_AUTH_TIME_KEY,
+  AUTH_SPNEGO_AUTH_TIME_KEY,
+)
+
+
+def _has_several_gunicorn_workers():
+  import sys
+  if 'rungunicornserver' not in sys.argv:
+    return False
+
+  # Avoid circular import
+  from desktop.conf import get_gunicorn_number_of_workers
+  return get_gunicorn_number_of_workers() > 1
+
+
+def _is_running(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+
+class WorkerMetricsSlots:
+  """
+  One row of float64 per Gunicorn worker in a shared memory block.
+
+  A row holds the worker pid and a version, followed by the SHARED_COUNT_KEYS counts and the TIME_SERIES_FIELDS
+  of each SHARED_TIME_SERIES_KEYS timer. The block is created by the main process before the workers are forked
+  so that they all inherit the same mapping.
+
+  Rows are written without a lock: the version is odd while a write is in progress and even once it is done.
+  Readers keep their own copy of the rows and only refresh the ones whose version changed since their last read,
+  skipping rows that are being written or changed while being copied. The cross-process lock is only used to
+  pick the row of a worker, with a timeout so that a worker killed while holding it cannot block the others.
+  """
+
+  HEADER_SIZE = 2
+  SLOT_SIZE = HEADER_SIZE + len(SHARED_COUNT_KEYS) + len(SHARED_TIME_SERIES_KEYS) * len(TIME_SERIES_FIELDS)
+  LOCK_TIMEOUT = 1.0
+  READ_RETRIES = 3
+
+  def __init__(self, max_workers=MAX_WORKERS):
+    # Only loaded by Gunicorn servers with several workers.
+    import numpy as np
+    from multiprocessing import Lock
+    from multiprocessing.shared_memory import SharedMemory
+
+    self._owner_pid = os.getpid()
+    self._lock = Lock()
+    self._shm = SharedMemory(create=True, size=max_workers * self.SLOT_SIZE * np.dtype(np.float64).itemsize)
+    self._slots = np.ndarray((max_workers, self.SLOT_SIZE), dtype=np.float64, buffer=self._shm.buf)
+    self._slots.fill(0)
+    self._rows = np.zeros((max_workers, self.SLOT_SIZE), dtype=np.float64)
+    self._slot_pid = None
+    self._slot = None
+    atexit.register(self.close)
+
+  def _begin_write(self, index):
+    # A worker killed in the middle of a write leaves an odd version, keep it odd.
+    version = self._slots[index, 1]
+    version += 1 if version % 2 == 0 else 2
+    self._slots[index, 1] = version
+    return version
+
+  def _end_write(self, index, version):
+    self._slots[index, 1] = version + 1
+
+  def _get_slot(self, pid):
+    if self._slot_pid == pid:
+      return self._slot
+
+    if not self._lock.acquire(timeout=self.LOCK_TIMEOUT):
+      LOG.warning('Could not pick a metrics slot for worker %d, skipping this update' % pid)
+      return None
+
+    try:
+      import numpy as np
+      pids = self._slots[:, 0]
+      slot = np.flatnonzero(pids == pid)
+      if not len(slot):
+        # Rows of workers that exited, e.g. after reaching max_requests, are stale and can be reused.
+        for index in np.flatnonzero(pids).tolist():
+          if not _is_running(int(pids[index])):
+            version = self._begin_write(index)
+            self._slots[index, 0] = 0
+            self._slots[index, self.HEADER_SIZE:] = 0
+            self._end_write(index, version)
+        slot = np.flatnonzero(pids == 0)
+      if not len(slot):
+        LOG.warning('All %d metrics slots are taken, worker %d is sharing one' % (len(pids), pid))
+        slot = [pid % len(pids)]
+      slot = int(slot[0])
+
+      # Claim the row before releasing the lock so that no other worker picks it.
+      version = self._begin_write(slot)
+      self._slots[slot, 0] = pid
+      self._end_write(slot, version)
+    finally:
+      self._lock.release()
+
+    self._slot_pid = pid
+    self._slot = slot
+    return self._slot
+
+  def write(self, pid, values):
+    slot = self._get_slot(pid)
+    if slot is None:
+      return
+
+    version = self._begin_write(slot)
+    self._slots[slot, 0] = pid
+    self._slots[slot, self.HEADER_SIZE:] = values
+    self._end_write(slot, version)
+
+  def read(self):
+    """
+    Returns a copy of the rows of the workers that published metrics so far, without the header columns.
+    """
+    import numpy as np
+    for _ in range(self.READ_RETRIES):
+      versions = self._slots[:, 1].copy()
+      changed = np.flatnonzero((versions != self._rows[:, 1]) & (versions % 2 == 0))
+      if not len(changed):
+        break
+
+      rows = self._slots[changed]
+      # Rows written while being copied are torn, they are retried.
+      consistent = self._slots[changed, 1] == versions[changed]
+      self._rows[changed[consistent]] = rows[consistent]
+      if consistent.all():
+        break
+
+    rows = self._rows[self._rows[:, 0] != 0]
+    return rows[:, self.HEADER_SIZE:]
+
+  def close(self):
+    if self._slots is None:
+      return
+    self._slots = None
+    self._shm.close()
+    if os.getpid() == self._owner_pid:
+      self._shm.unlink()
+
+
+class MetricsRegistry:
+  def __init__(self, registry=None, flush_interval=WORKER_METRICS_FLUSH_INTERVAL):
     if registry is None:
+      import pyformance
       registry = pyformance.global_registry()
     self._registry = registry
     self._schemas = []
-    global metrics_dict
-    metrics_dict = Manager().dict() if 'rungunicornserver' in sys.argv else None
-    self._metrics_dict = metrics_dict
+    self._histogram_keys = set()
+    self._last_dump = None
+    self._last_dump_ts = 0.0
+    # A single Gunicorn worker serves all the requests and reports its own metrics, there is nothing to aggregate.
+    self._worker_slots = WorkerMetricsSlots() if _has_several_gunicorn_workers() else None
+    self._flush_interval = flush_interval
+    self._flusher_pid = None
+    self._flusher = None
+    self._flusher_stop = None
+    self._flusher_lock = threading.Lock()
+    self._dirty = False
+    if self._worker_slots is not None:
+      # Registered after WorkerMetricsSlots.close, so it runs before it.
+      atexit.register(self.stop)
 
   def _register_schema(self, schema):
     self._schemas.append(schema)
+    self._last_dump = None
 
   @property
   def schemas(self):
     return list(self._schemas)
 
   def counter(self, name, **kwargs):
-    self._schemas.append(CounterDefinition(name, **kwargs))
+    self._register_schema(CounterDefinition(name, **kwargs))
     return self._registry.counter(name)
 
   def histogram(self, name, **kwargs):
-    self._schemas.append(HistogramDefinition(name, **kwargs))
+    self._register_schema(HistogramDefinition(name, **kwargs))
+    self._histogram_keys.add(name)
     return self._registry.histogram(name)
 
   def gauge(self, name, gauge=None, default=float('nan'), **kwargs):
-    self._schemas.append(GaugeDefinition(name, **kwargs))
+    self._register_schema(GaugeDefinition(name, **kwargs))
     return self._registry.gauge(name, gauge, default)
 
   def gauge_callback(self, name, callback, default=float('nan'), **kwargs):
-    self._schemas.append(GaugeDefinition(name, **kwargs))
-    return self._registry.gauge(name, pyformance.meters.CallbackGauge(callback), default)
+    from pyformance.meters import CallbackGauge
+    self._register_schema(GaugeDefinition(name, **kwargs))
+    return self._registry.gauge(name, CallbackGauge(callback), default)
 
   def meter(self, name, **kwargs):
-    self._schemas.append(MeterDefinition(name, **kwargs))
+    self._register_schema(MeterDefinition(name, **kwargs))
     return self._registry.meter(name)
 
   def timer(self, name, **kwargs):
-    self._schemas.append(TimerDefinition(name, **kwargs))
+    self._register_schema(TimerDefinition(name, **kwargs))
+    self._histogram_keys.add(name)
     return Timer(self._registry.timer(name))
 
+  def mark_metrics_dirty(self):
+    """
+    Called by the middleware of the Gunicorn workers. The metrics are published to the main process by a
+    background thread of the worker, at most once every flush_interval seconds.
+    """
+    if self._worker_slots is None:
+      return
+
+    self._dirty = True
+    if self._flusher_pid != os.getpid():
+      self._start_flusher()
+
+  def _start_flusher(self):
+    with self._flusher_lock:
+      # Threads do not survive the fork, so each worker starts its own.
+      if self._flusher_pid == os.getpid():
+        return
+      self._flusher_pid = os.getpid()
+      self._flusher_stop = threading.Event()
+      self._flusher = threading.Thread(target=self._flush_metrics_shared_data, args=(self._flusher_stop,),
+          name='metrics-flusher', daemon=True)
+      self._flusher.start()
+
+  def stop(self):
+    """
+    Stops the flusher thread of the current process, if it has one.
+    """
+    with self._flusher_lock:
+      if self._flusher_pid != os.getpid():
+        return
+      flusher = self._flusher
+      self._flusher_stop.set()
+      self._flusher_pid = None
+      self._flusher = None
+    flusher.join()
+
+  def _flush_metrics_shared_data(self, stop):
+    while not stop.wait(self._flush_interval):
+      if not self._dirty:
+        continue
+      self._dirty = False
+      try:
+        self.update_metrics_shared_data()
+      except Exception:
+        LOG.exception('failed to publish the metrics of worker %d' % os.getpid())
+
   def update_metrics_shared_data(self):
-    # Update from middleware in Gunicorn worker process
-    metrics = self.dump_metrics()
-    if self._metrics_dict is not None:
-      self._metrics_dict[os.getpid()] = metrics
+    # Update from the flusher thread in Gunicorn worker process
+    if self._worker_slots is not None:
+      self._worker_slots.write(os.getpid(), self._get_shared_values(self.dump_metrics()))
+
+  def _get_shared_values(self, metrics):
+    values = [metrics[key]['count'] if key in metrics else 0 for key in SHARED_COUNT_KEYS]
+    for key in SHARED_TIME_SERIES_KEYS:
+      if key in metrics:
+        values.extend(metrics[key][field] for field in TIME_SERIES_FIELDS)
+      else:
+        values.extend(0.0 for field in TIME_SERIES_FIELDS)
+    return values
 
   def get_metrics_shared_data(self):
     # Getting from reporter in Gunicorn main process
-    metrics_data = self._metrics_dict.values() if self._metrics_dict is not None else []
-    size = len(metrics_data)
-
-    if size > 0:
-      active_requests_list = []
-      active_exceptions_list = []
-      requests_response_time_list = []
-      auth_oauth_auth_time_list = []
-      auth_saml2_auth_time_list = []
-      auth_ldap_auth_time_list = []
-      auth_pam_auth_time_list = []
-      auth_spnego_auth_time_list = []
-
-      for value in metrics_data:
-        active_requests_list.append(value['requests.active'])
-        active_exceptions_list.append(value['requests.exceptions'])
-        requests_response_time_list.append(value[REQUESTS_RESPONSE_TIME_KEY])
-        auth_oauth_auth_time_list.append(value[AUTH_OAUTH_AUTH_TIME_KEY])
-        auth_saml2_auth_time_list.append(value[AUTH_SAML2_AUTH_TIME_KEY])
-        auth_ldap_auth_time_list.append(value[AUTH_LDAP_AUTH_TIME_KEY])
-        auth_pam_auth_time_list.append(value[AUTH_PAM_AUTH_TIME_KEY])
-        auth_spnego_auth_time_list.append(value[AUTH_SPNEGO_AUTH_TIME_KEY])
-
-      metrics_master = self.dump_metrics()
-      self.calculate_count(metrics_master[REQUESTS_ACTIVE_KEY], active_requests_list)
-      self.calculate_count(metrics_master[REQUESTS_EXCEPTIONS_KEY], active_exceptions_list)
-      self.calculate_time_series(metrics_master[REQUESTS_RESPONSE_TIME_KEY], requests_response_time_list, size)
-      self.calculate_time_series(metrics_master[AUTH_OAUTH_AUTH_TIME_KEY], auth_oauth_auth_time_list, size)
-      self.calculate_time_series(metrics_master[AUTH_SAML2_AUTH_TIME_KEY], auth_saml2_auth_time_list, size)
-      self.calculate_time_series(metrics_master[AUTH_LDAP_AUTH_TIME_KEY], auth_ldap_auth_time_list, size)
-      self.calculate_time_series(metrics_master[AUTH_PAM_AUTH_TIME_KEY], auth_pam_auth_time_list, size)
-      self.calculate_time_series(metrics_master[AUTH_SPNEGO_AUTH_TIME_KEY], auth_spnego_auth_time_list, size)
+    workers = self._worker_slots.read() if self._worker_slots is not None else None
+
+    if workers is not None and len(workers) > 0:
+      # The dump is cached, so copy the entries that get overwritten with the aggregates.
+      metrics_master = dict(self.dump_metrics())
+
+      for index, key in enumerate(SHARED_COUNT_KEYS):
+        if key in metrics_master:
+          metrics_master[key] = dict(metrics_master[key])
+          self.calculate_count(metrics_master[key], workers[:, index])
+
+      num_fields = len(TIME_SERIES_FIELDS)
+      for index, key in enumerate(SHARED_TIME_SERIES_KEYS):
+        if key in metrics_master:
+          start = len(SHARED_COUNT_KEYS) + index * num_fields
+          metrics_master[key] = dict(metrics_master[key])
+          self.calculate_time_series(metrics_master[key], workers[:, start:start + num_fields])
 
       return metrics_master
     else:
       return self.dump_metrics()
 
-  def calculate_count(self, count_obj, count_list):
-    value = 0
-    for count in count_list:
-      value += count['count']
-    count_obj['count'] = value
-
-  def calculate_time_series(self, time_obj, time_list, size):
-    avg_list = []
-    sum_list = []
-    count_list = []
-    max_lit = []
-    min_list = []
-    std_dev_list = []
-    rate_15m_list = []
-    rate_5m_list = []
-    rate_1m_list = []
-    mean_rate_list = []
-    # percentile_50_list = []
-    percentile_75_list = []
-    percentile_95_list = []
-    percentile_99_list = []
-    percentile_999_list = []
-
-    for time in time_list:
-      avg_list.append(time['avg'])
-      sum_list.append(time['sum'])
-      count_list.append(time['count'])
-      max_lit.append(time['max'])
-      min_list.append(time['min'])
-      std_dev_list.append(time['std_dev'])
-      rate_15m_list.append(time['15m_rate'])
-      rate_5m_list.append(time['5m_rate'])
-      rate_1m_list.append(time['1m_rate'])
-      mean_rate_list.append(time['mean_rate'])
-      # percentile_50_list.append(time['50_percentile'])
-      percentile_75_list.append(time['75_percentile'])
-      percentile_95_list.append(time['95_percentile'])
-      percentile_99_list.append(time['99_percentile'])
-      percentile_999_list.append(time['999_percentile'])
-
-    time_obj['avg'] = sum(avg_list) / size
-    time_obj['sum'] = sum(sum_list) / size
-    time_obj['count'] = sum(count_list)
-    time_obj['max'] = sum(max_lit) / size
-    time_obj['min'] = sum(min_list) / size
-    time_obj['std_dev'] = sum(std_dev_list) / size
-    time_obj['15m_rate'] = sum(rate_15m_list) / size
-    time_obj['5m_rate'] = sum(rate_5m_list) / size
-    time_obj['1m_rate'] = sum(rate_1m_list) / size
-    time_obj['mean_rate'] = sum(mean_rate_list) / size
-    # time_obj['50_percentile'] = sum(percentile_50_list) / size
-    time_obj['75_percentile'] = sum(percentile_75_list) / size
-    time_obj['95_percentile'] = sum(percentile_95_list) / size
-    time_obj['99_percentile'] = sum(percentile_99_list) / size
-    time_obj['999_percentile'] = sum(percentile_999_list) / size
+  def calculate_count(self, count_obj, counts):
+    count_obj['count'] = int(counts.sum())
+
+  def calculate_time_series(self, time_obj, values):
+    # One row per worker, one column per field of TIME_SERIES_FIELDS. A single column-wise sum gives both the
+    # averages and the total count.
+    totals = values.sum(axis=0)
+    for field, mean in zip(TIME_SERIES_FIELDS, (totals / len(values)).tolist()):
+      time_obj[field] = mean
+    time_obj['count'] = int(totals[_TIME_SERIES_COUNT_INDEX])
 
   def get_hue_metrics(self, key):
     return self._registry.get_metrics(key)
 
   def dump_metrics(self):
+    """
+    Returns the current metrics, reusing the previous dump if it is less than DUMP_METRICS_TTL seconds old.
+    The returned dict is shared between callers and must not be modified.
+    """
+    now = time.monotonic()
+    if self._last_dump is not None and now - self._last_dump_ts < DUMP_METRICS_TTL:
+      return self._last_dump
+
     metrics = self._registry.dump_metrics()
 
-    # Filter out min and max if there have been no samples.
-    for metric in metrics.values():
-      if metric.get('count') == 0:
-        if 'min' in metric:
-          metric['min'] = 0.0
+    # Filter out min and max if there have been no samples. Only histograms and timers have them.
+    for key in self._histogram_keys:
+      metric = metrics[key]
+      if metric['count'] == 0:
+        metric['min'] = 0.0
+        metric['max'] = 0.0
 
-        if 'max' in metric:
-          metric['max'] = 0.0
+    self._last_dump = metrics
+    self._last_dump_ts = now
 
     return metrics
 
 
-class MetricDefinition(object):
+class MetricDefinition:
   _add_key_to_name = False
 
   def __init__(self, name, label, description, numerator,
@@ -252,6 +452,8 @@ class MetricDefinition(object):
     self.numerator = numerator
     self.denominator = denominator
     self.weighting_metric_name = weighting_metric_name
+    self._names_prefix = 'hue_' + self.name.replace('.', '_').replace('-', '_')
+    self._json = None
 
     assert self.name is not None
     assert self.label is not None
@@ -260,6 +462,15 @@ class MetricDefinition(object):
 
 
   def to_json(self):
+    """
+    Schemas do not change once registered, so the definitions are only built once and then shared.
+    """
+    if self._json is None:
+      self._json = self._build_json()
+    return self._json
+
+
+  def _build_json(self):
     raise NotImplementedError
 
 
@@ -268,8 +479,6 @@ class MetricDefinition(object):
       label_suffix=None,
       description_suffix=None,
       **kwargs):
-    names = ['hue', self.name.replace('.', '_').replace('-', '_')]
-
     label = self.label
     description = self.description
 
@@ -286,14 +495,16 @@ class MetricDefinition(object):
       description += description_suffix
 
     if self._add_key_to_name:
-      names.append(key)
+      name = '%s_%s' % (self._names_prefix, key)
+    else:
+      name = self._names_prefix
 
     if 'counter' in kwargs and not kwargs['counter']:
       kwargs.pop('counter')
 
     mdl = dict(
       context='%s::%s' % (self.name, key),
-      name='_'.join(names),
+      name=name,
       label=label,
       description=description,
       numeratorUnit=self.numerator,
@@ -314,7 +525,7 @@ class CounterDefinition(MetricDefinition):
         "Counters should not have denominators"
 
 
-  def to_json(self):
+  def _build_json(self):
     return [
         self._make_json('count', counter=not self.treat_counter_as_gauge),
     ]
@@ -329,7 +540,7 @@ class HistogramDefinition(MetricDefinition):
     super(HistogramDefinition, self).__init__(*args, **kwargs)
 
 
-  def to_json(self):
+  def _build_json(self):
     return [
         self._make_json('max',
           label_suffix=MAX_LABEL_SUFFIX,
@@ -381,7 +592,7 @@ class GaugeDefinition(MetricDefinition):
         "Gauge metrics that are marked as counters cannot have a denominator"
 
 
-  def to_json(self):
+  def _build_json(self):
     return [
         self._make_json('value', counter=self.treat_gauge_as_counter),
     ]
@@ -399,7 +610,7 @@ class MeterDefinition(MetricDefinition):
 
     super(MeterDefinition, self).__init__(*args, **kwargs)
 
-  def to_json(self):
+  def _build_json(self):
     return [
         self._make_json('count',
           label_suffix=SAMPLE_SUM_LABEL_SUFFIX,
@@ -437,7 +648,7 @@ class TimerDefinition(MetricDefinition):
     super(TimerDefinition, self).__init__(*args, **kwargs)
 
 
-  def to_json(self):
+  def _build_json(self):
     return [
         self._make_json('max',
           label_suffix=MAX_LABEL_SUFFIX,
@@ -494,7 +705,7 @@ class TimerDefinition(MetricDefinition):
     ]
 
 
-class Timer(object):
+class Timer:
   """
   Wrapper around the pyformance Timer object to allow it to be used in an
   annotation.
@@ -502,11 +713,14 @@ class Timer(object):
 
   def __init__(self, timer):
     self._timer = timer
+    self._time = timer.time
 
   def __call__(self, fn, *args, **kwargs):
+    timer_time = self._time
+
     @functools.wraps(fn)
     def wrapper(*args, **kwargs):
-      with self._timer.time():
+      with timer_time():
         return fn(*args, **kwargs)
 
     return wrapper
@@ -515,8 +729,16 @@ class Timer(object):
     return getattr(self._timer, *args, **kwargs)
 
 
-_global_registry = MetricsRegistry()
+_global_registry = None
+_global_registry_lock = threading.Lock()
 
 
 def global_registry():
+  global _global_registry
+
+  # Built on first use so that commands which never touch the metrics do not load pyformance.
+  if _global_registry is None:
+    with _global_registry_lock:
+      if _global_registry is None:
+        _global_registry = MetricsRegistry()
   return _global_registry
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# Licensed to Cloudera, Inc. under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  Cloudera, Inc. licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import os
+import pyformance
+import time
+
+from unittest.mock import patch
+
+from desktop.lib.metrics.registry import MetricsRegistry, WorkerMetricsSlots, REQUESTS_ACTIVE_KEY, REQUESTS_RESPONSE_TIME_KEY, \
+    TIME_SERIES_FIELDS, DUMP_METRICS_TTL
+
+
+def _make_registry():
+  return MetricsRegistry(registry=pyformance.MetricsRegistry())
+
+
+def test_calculate_count():
+  registry = _make_registry()
+  count_obj = {}
+
+  registry.calculate_count(count_obj, np.array([2.0, 0.0, 7.0]))
+
+  assert count_obj == {'count': 9}
+  assert isinstance(count_obj['count'], int)
+
+
+def test_calculate_time_series():
+  registry = _make_registry()
+  values = np.array([
+    [1.0] * len(TIME_SERIES_FIELDS),
+    [3.0] * len(TIME_SERIES_FIELDS),
+  ])
+  values[:, TIME_SERIES_FIELDS.index('count')] = [3, 5]
+  time_obj = {'median': 42.0}
+
+  registry.calculate_time_series(time_obj, values)
+
+  assert time_obj.pop('count') == 8
+  assert time_obj.pop('median') == 42.0
+  assert time_obj == dict((field, 2.0) for field in TIME_SERIES_FIELDS if field != 'count')
+
+
+def test_worker_metrics_slots():
+  slots = WorkerMetricsSlots(max_workers=2)
+  num_values = WorkerMetricsSlots.SLOT_SIZE - WorkerMetricsSlots.HEADER_SIZE
+
+  try:
+    assert slots.read().shape == (0, num_values)
+
+    slots.write(os.getpid(), [1.0] * num_values)
+    slots.write(os.getpid(), [2.0] * num_values)
+
+    workers = slots.read()
+    assert workers.shape == (1, num_values)
+    assert (workers == 2.0).all()
+
+    # A row being written keeps its previous values until the write is done
+    slots._slots[0, 1] += 1
+    slots._slots[0, WorkerMetricsSlots.HEADER_SIZE:] = 9.0
+    assert (slots.read() == 2.0).all()
+    slots._slots[0, 1] += 1
+    assert (slots.read() == 9.0).all()
+    slots.write(os.getpid(), [2.0] * num_values)
+
+    slots.write(os.getpid() + 1, [3.0] * num_values)
+
+    workers = slots.read()
+    assert workers.shape == (2, num_values)
+    assert (workers[0] == 2.0).all()
+    assert (workers[1] == 3.0).all()
+
+    # A lock left held by a killed worker only skips the update of a new worker
+    slots.LOCK_TIMEOUT = 0.01
+    slots._lock.acquire()
+    try:
+      slots.write(os.getpid() + 2, [4.0] * num_values)
+    finally:
+      slots._lock.release()
+    assert (slots.read() != 4.0).all()
+  finally:
+    slots.close()
+
+
+def test_get_metrics_shared_data():
+  registry = _make_registry()
+  active_requests = registry.counter(REQUESTS_ACTIVE_KEY, label='Active Requests', description='Active Requests',
+      numerator='requests')
+  registry.timer(REQUESTS_RESPONSE_TIME_KEY, label='Request Time', description='Request Time', numerator='ms',
+      counter_numerator='requests', rate_denominator='seconds')
+  registry._worker_slots = WorkerMetricsSlots(max_workers=2)
+
+  try:
+    # Frozen clock, the dump of this process stays cached during the whole test
+    with patch('desktop.lib.metrics.registry.time') as clock:
+      clock.monotonic.return_value = 100.0
+
+      registry.update_metrics_shared_data()
+      active_requests.inc(3)
+      registry._worker_slots.write(os.getpid() + 1, registry._get_shared_values(registry._registry.dump_metrics()))
+
+      metrics = registry.get_metrics_shared_data()
+
+      assert metrics[REQUESTS_ACTIVE_KEY] == {'count': 3}
+      assert metrics[REQUESTS_RESPONSE_TIME_KEY]['count'] == 0
+      assert registry.dump_metrics()[REQUESTS_ACTIVE_KEY] == {'count': 0}
+  finally:
+    registry._worker_slots.close()
+
+
+def test_mark_metrics_dirty_publishes_in_the_background():
+  registry = MetricsRegistry(registry=pyformance.MetricsRegistry(), flush_interval=0.01)
+  registry.counter(REQUESTS_ACTIVE_KEY, label='Active Requests', description='Active Requests', numerator='requests')
+  registry._worker_slots = WorkerMetricsSlots(max_workers=2)
+
+  try:
+    assert len(registry._worker_slots.read()) == 0
+
+    registry.mark_metrics_dirty()
+
+    for _ in range(100):
+      if len(registry._worker_slots.read()) > 0:
+        break
+      time.sleep(0.01)
+    assert len(registry._worker_slots.read()) == 1
+    assert registry._flusher_pid == os.getpid()
+  finally:
+    flusher = registry._flusher
+    registry.stop()
+    registry._worker_slots.close()
+
+  assert not flusher.is_alive()
+
+
+def test_dump_metrics_is_cached_until_a_metric_is_registered():
+  registry = _make_registry()
+  counter = registry.counter('test.counter', label='Counter', description='Counter', numerator='requests')
+
+  with patch('desktop.lib.metrics.registry.time') as clock:
+    clock.monotonic.return_value = 100.0
+
+    metrics = registry.dump_metrics()
+    counter.inc()
+    assert registry.dump_metrics() is metrics
+
+    registry.counter('test.other-counter', label='Other', description='Other', numerator='requests')
+    metrics = registry.dump_metrics()
+    assert 'test.other-counter' in metrics
+    assert metrics['test.counter'] == {'count': 1}
+
+    counter.inc()
+    clock.monotonic.return_value += DUMP_METRICS_TTL / 2
+    assert registry.dump_metrics() is metrics
+
+    # Expired dumps are refreshed
+    clock.monotonic.return_value += DUMP_METRICS_TTL
+    assert registry.dump_metrics()['test.counter'] == {'count': 2}
+
+
+def test_to_json_is_built_once():
+  registry = _make_registry()
+  registry.timer('test.timer', label='Timer', description='Timer', numerator='ms', counter_numerator='calls',
+      rate_denominator='seconds')
+  schema = registry.schemas[0]
+
+  definitions = schema.to_json()
+
+  assert schema.to_json() is definitions
+  assert definitions[0]['name'] == 'hue_test_timer_max'
+  assert definitions[0]['context'] == 'test.timer::max'
+
+
+def test_timer_decorator():
+  registry = _make_registry()
+  timer = registry.timer('test.timer', label='Timer', description='Timer', numerator='ms', counter_numerator='calls',
+      rate_denominator='seconds')
+
+  @timer
+  def add(a, b):
+    return a + b
+
+  assert add(1, b=2) == 3
+  assert add.__name__ == 'add'
+  assert timer.get_count() == 1
+
+
+def test_dump_metrics_without_samples():
+  registry = _make_registry()
+  registry.counter('test.counter', label='Counter', description='Counter', numerator='requests')
+  registry.timer('test.timer', label='Timer', description='Timer', numerator='ms', counter_numerator='calls',
+      rate_denominator='seconds')
+
+  metrics = registry.dump_metrics()
+
+  assert metrics['test.counter'] == {'count': 0}
+  assert metrics['test.timer']['min'] == 0.0
+  assert metrics['test.timer']['max'] == 0.0
@@ -213,7 +213,7 @@ def rungunicornserver(args=[], options={}):
       'worker_class': conf.GUNICORN_WORKER_CLASS.get(),
       'worker_connections': 1000,
       'worker_tmp_dir': options['worker_tmp_dir'],
-      'workers': conf.GUNICORN_NUMBER_OF_WORKERS.get() if conf.GUNICORN_NUMBER_OF_WORKERS.get() is not None else 5,
+      'workers': conf.get_gunicorn_number_of_workers(),
       'post_fork': post_fork,
       'post_worker_init': post_worker_init,
       'worker_int': worker_int
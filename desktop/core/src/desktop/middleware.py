@@ -885,7 +885,7 @@ class MetricsMiddleware(MiddlewareMixin):
     self._response_timer = metrics.response_time.time()
     metrics.active_requests.inc()
     if is_gunicorn_report_enabled():
-      global_registry().update_metrics_shared_data()
+      global_registry().mark_metrics_dirty()
 
   def process_exception(self, request, exception):
     self._response_timer.stop()
@@ -895,7 +895,7 @@ class MetricsMiddleware(MiddlewareMixin):
     self._response_timer.stop()
     metrics.active_requests.dec()
     if is_gunicorn_report_enabled():
-      global_registry().update_metrics_shared_data()
+      global_registry().mark_metrics_dirty()
     return response
 
 
@@ -18,27 +18,32 @@
 import logging
 import pytest
 import os
+import shutil
 import stat
 import tempfile
 import unittest
 
-from django.test import TestCase
 from hadoop import fs, pseudo_hdfs4
 
 
 logger = logging.getLogger()
 
+# A few KB are enough to exercise the copies without paying for extra HDFS round trips.
+COPY_TEST_DATA = "I will not make flatulent noises in class\n" * 64
 
-class LocalSubFileSystemTest(TestCase):
-  def setup_method(self, method):
-    self.root = tempfile.mkdtemp()
-    self.fs = fs.LocalSubFileSystem(self.root)
 
-  def teardown_method(self, method):
-    if not os.listdir(self.root):
-      os.rmdir(self.root)
-    else:
-      logger.warning("Tests did not clean up after themselves in %s" % self.root)
+@pytest.fixture(scope="module")
+def minicluster():
+  return pseudo_hdfs4.shared_cluster()
+
+
+class TestLocalSubFileSystem(object):
+  @pytest.fixture(autouse=True)
+  def local_fs(self, request, tmp_path_factory):
+    # Numbered directories under the session base temp, removed even when the test fails.
+    self.root = str(tmp_path_factory.mktemp("localfs", numbered=True))
+    request.addfinalizer(lambda: shutil.rmtree(self.root, ignore_errors=True))
+    self.fs = fs.LocalSubFileSystem(self.root)
 
   def test_resolve_path(self):
     assert self.root + "/" == self.fs._resolve_path("/")
@@ -101,19 +106,18 @@ class LocalSubFileSystemTest(TestCase):
 
 @pytest.mark.integration
 @pytest.mark.requires_hadoop
-def test_hdfs_copy():
-  minicluster = pseudo_hdfs4.shared_cluster()
+def test_hdfs_copy(minicluster):
   minifs = minicluster.fs
 
   copy_test_src = minicluster.fs_prefix + '/copy_test_src'
   copy_test_dst = minicluster.fs_prefix + '/copy_test_dst'
   try:
-    data = "I will not make flatulent noises in class\n" * 2000
+    data = COPY_TEST_DATA
     minifs.create(copy_test_src, permission=0o646, data=data)
     minifs.create(copy_test_dst, data="some initial data")
 
     minifs.copyfile(copy_test_src, copy_test_dst)
-    actual = minifs.read(copy_test_dst, 0, len(data) + 100)
+    actual = minifs.read(copy_test_dst, 0, len(data))
     assert data == actual
 
     sb = minifs.stats(copy_test_dst)
@@ -125,8 +129,7 @@ def test_hdfs_copy():
 
 @pytest.mark.integration
 @pytest.mark.requires_hadoop
-def test_hdfs_full_copy():
-  minicluster = pseudo_hdfs4.shared_cluster()
+def test_hdfs_full_copy(minicluster):
   minifs = minicluster.fs
   minifs.setuser('test')
 
@@ -138,8 +141,7 @@ def test_hdfs_full_copy():
 
     # File to directory copy.
     # No guarantees on file permissions at the moment.
-    data = "I will not make flatulent noises in class\n" * 2000
-    minifs.create(prefix + '/src/file.txt', permission=0o646, data=data)
+    minifs.create(prefix + '/src/file.txt', permission=0o646, data=COPY_TEST_DATA)
     minifs.copy(prefix + '/src/file.txt', prefix + '/dest')
     assert minifs.exists(prefix + '/dest/file.txt')
 
@@ -161,15 +163,14 @@ def test_hdfs_full_copy():
 
 @pytest.mark.integration
 @pytest.mark.requires_hadoop
-def test_hdfs_copy_from_local():
-  minicluster = pseudo_hdfs4.shared_cluster()
+def test_hdfs_copy_from_local(minicluster):
   minifs = minicluster.fs
   minifs.setuser('test')
 
   path = os.path.join(tempfile.gettempdir(), 'copy_test_src')
   logging.info(path)
 
-  data = "I will not make flatulent noises in class\n" * 2000
+  data = COPY_TEST_DATA
   f = open(path, 'w')
   f.write(data)
   f.close()
@@ -177,7 +178,7 @@ def test_hdfs_copy_from_local():
   copy_dest = minicluster.fs_prefix + '/copy_test_dst'
 
   minifs.copyFromLocal(path, copy_dest)
-  actual = minifs.read(copy_dest, 0, len(data) + 100)
+  actual = minifs.read(copy_dest, 0, len(data))
   assert data == actual
 
 
@@ -19,10 +19,13 @@ from builtins import range, object
 import logging
 import re
 import sys
+import threading
 import time
-import textwrap
 import json
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
 from beeswax.server.dbms import Table
 
 from desktop.conf import USE_DEFAULT_CONFIGURATION
@@ -52,26 +55,95 @@ except ImportError as e:
 
 SESSION_KEY = '%(username)s-%(interpreter_name)s'
 
+POLL_TIMEOUT = 120
+POLL_INITIAL_DELAY = 0.05
+POLL_MAX_DELAY = 2.0
+POLL_BACKOFF = 1.6
+SESSION_CHECK_TTL = 2.0
+CLOSE_SESSIONS_MAX_WORKERS = 4  # Livy does not like many concurrent admin calls
+FETCH_DATA_TTL = 1.0
+FETCH_DATA_MAX_ENTRIES = 100
+FETCH_DATA_MAX_BYTES = 10 * 1024 * 1024
+
+# Finished statement responses seen by check_status, picked up by the following fetch_result.
+# Values are (timestamp, size, response).
+_RECENT_FETCHES = {}
+_RECENT_FETCHES_LOCK = threading.Lock()
+_RECENT_FETCHES_BYTES = 0
+
+
+def _poll(fn, pending_states, timeout=POLL_TIMEOUT):
+  '''
+  Calls fn until the 'state' of its response leaves pending_states or timeout seconds have passed.
+  The delay between calls grows from POLL_INITIAL_DELAY up to POLL_MAX_DELAY, so quick statements return fast
+  while long ones do not hammer Livy.
+  '''
+  start = time.monotonic()
+  delay = POLL_INITIAL_DELAY
+  status = fn()
+
+  while status['state'] in pending_states and time.monotonic() - start < timeout:
+    time.sleep(delay)
+    delay = min(delay * POLL_BACKOFF, POLL_MAX_DELAY)
+    status = fn()
+
+  return status
+
+
+def _drop_recent_fetch(key):
+  # Called with _RECENT_FETCHES_LOCK held
+  global _RECENT_FETCHES_BYTES
+  _RECENT_FETCHES_BYTES -= _RECENT_FETCHES.pop(key)[1]
+
+
+def _expire_recent_fetch(key, timestamp):
+  # Runs FETCH_DATA_TTL seconds after the response was stored, unless fetch_result picked it up first
+  with _RECENT_FETCHES_LOCK:
+    cached = _RECENT_FETCHES.get(key)
+    if cached is not None and cached[0] == timestamp:
+      _drop_recent_fetch(key)
+
+
+@lru_cache(maxsize=1)
+def _yarn_mode():
+  # The Spark mode does not change while Hue runs
+  return LIVY_SERVER_SESSION_KIND.get() == "yarn"
+
+
 class SparkApi(Api):
 
-  SPARK_UI_RE = re.compile("Started SparkUI at (http[s]?://([0-9a-zA-Z-_\.]+):(\d+))")
-  YARN_JOB_RE = re.compile("tracking URL: (http[s]?://.+/)")
-  STANDALONE_JOB_RE = re.compile("Got job (\d+)")
+  # Livy log lines only contain ASCII digits in the parts we match
+  SPARK_UI_RE = re.compile(r"Started SparkUI at (http[s]?://([0-9a-zA-Z-_\.]+):(\d+))", re.ASCII)
+  YARN_JOB_RE = re.compile(r"tracking URL: (http[s]?://.+/)", re.ASCII)
+  STANDALONE_JOB_RE = re.compile(r"Got job (\d+)", re.ASCII)
+  SESSION_NOT_FOUND_RE = re.compile(r"session (?:'\d+' )?not found", re.ASCII)
 
 
   def __init__(self, user, interpreter):
     super(SparkApi, self).__init__(user=user, interpreter=interpreter)
+    self.user = rewrite_user(self.user)
+    self._session_key = SESSION_KEY % {
+      'username': self.user.username if hasattr(self.user, 'username') else self.user,
+      'interpreter_name': self.interpreter['name']
+    }
+    self._api = None
+    self._session_check_cache = {}
 
 
   def get_api(self):
-    return get_spark_api(self.user, self.interpreter)
+    if self._api is None:
+      self._api = get_spark_api(self.user, self.interpreter)
+    else:
+      # The Livy client keeps its proxy user in a thread local
+      self._api.setuser(self.user)
+    return self._api
 
 
   @staticmethod
   def get_livy_props(lang, properties=None):
-    props = dict([(p['name'], p['value']) for p in SparkConfiguration.PROPERTIES])
+    props = dict(_DEFAULT_LIVY_PROPS)
     if properties is not None:
-      props.update(dict([(p['name'], p['value']) for p in properties if 'name' in p.keys() and 'value' in p.keys()]))
+      props.update({p['name']: p['value'] for p in properties if 'name' in p and 'value' in p})
 
     # HUE-4761: Hue's session request is causing Livy to fail with "JsonMappingException: Can not deserialize
     # instance of scala.collection.immutable.List out of VALUE_STRING token" due to List type values
@@ -82,19 +154,19 @@ class SparkApi(Api):
     # empty list '[]' for these four values.
     # Note also that Livy has a 90 second timeout for the session request to complete, this needs to
     # be increased for requests that take longer, for example when loading large archives.
-    for key in ['archives', 'jars', 'files', 'pyFiles']:
-      if key not in props:
-        continue
-      if type(props[key]) is list:
-        continue
-      LOG.debug("Check List type: {} was not a list".format(key))
-      _tmp = props[key]
-      props[key] = _tmp.split(",")
+    for key in ('archives', 'jars', 'files', 'pyFiles'):
+      value = props.get(key)
+      if isinstance(value, str):
+        LOG.debug("Check List type: %s was not a list", key)
+        props[key] = [v for v in value.split(',') if v]
 
     # Convert the conf list to a dict for Livy
-    LOG.debug("Property Spark Conf kvp list from UI is: " + str(props['conf']))
-    props['conf'] = {conf.get('key'): conf.get('value') for i, conf in enumerate(props['conf'])}
-    LOG.debug("Property Spark Conf dictionary is: " + str(props['conf']))
+    conf_list = props['conf']
+    LOG.debug("Property Spark Conf kvp list from UI is: %s", conf_list)
+    props['conf'] = {conf['key']: conf.get('value') for conf in conf_list if conf.get('key') is not None}
+    if len(props['conf']) != len(conf_list):
+      LOG.warning('Ignored %d Spark Conf entries without a key or with a duplicated key', len(conf_list) - len(props['conf']))
+    LOG.debug("Property Spark Conf dictionary is: %s", props['conf'])
 
     props['kind'] = 'sql' if lang == 'sparksql' else lang
 
@@ -103,37 +175,48 @@ class SparkApi(Api):
 
   @staticmethod
   def to_properties(props=None):
-    properties = list()
-    for p in SparkConfiguration.PROPERTIES:
-      properties.append(p.copy())
+    '''
+    Returns the session properties with the values of props. Properties not in props are the shared
+    SparkConfiguration entries and must not be mutated.
+    '''
+    if props is None:
+      return list(_PROPERTY_TEMPLATES)
 
-    if props is not None:
-      for p in properties:
-        if p['name'] in props:
-          p['value'] = props[p['name']]
+    properties = []
+    for p in _PROPERTY_TEMPLATES:
+      if p['name'] in props:
+        p = p.copy()
+        p['value'] = props[p['name']]
+      properties.append(p)
 
     return properties
 
 
   def _get_session_key(self):
-    return SESSION_KEY % {
-      'username': self.user.username if hasattr(self.user, 'username') else self.user,
-      'interpreter_name': self.interpreter['name']
-    }
+    return self._session_key
 
 
   def _check_session(self, session):
     '''
     Check if the session is actually present and its state is healthy.
+    The verdict is reused for SESSION_CHECK_TTL seconds as one UI action checks the same session several times.
     '''
+    now = time.monotonic()
+    cached = self._session_check_cache.get(session['id'])
+    if cached is not None and now - cached[1] < SESSION_CHECK_TTL:
+      return cached[0]
+
     api = self.get_api()
     try:
       session_present = api.get_session(session['id'])
     except Exception as e:
       session_present = None
 
-    if session_present and session_present['state'] not in ('dead', 'shutting_down', 'error', 'killed'):
-      return session_present
+    if not session_present or session_present['state'] in ('dead', 'shutting_down', 'error', 'killed'):
+      session_present = None
+
+    self._session_check_cache[session['id']] = (session_present, now)
+    return session_present
 
 
   def create_session(self, lang='scala', properties=None):
@@ -154,13 +237,7 @@ class SparkApi(Api):
 
     response = api.create_session(**props)
 
-    status = api.get_session(response['id'])
-    count = 0
-
-    while status['state'] == 'starting' and count < 120:
-      status = api.get_session(response['id'])
-      count += 1
-      time.sleep(1)
+    status = _poll(lambda: api.get_session(response['id']), ('starting',))
 
     if status['state'] != 'idle':
       info = '\n'.join(status['log']) if status['log'] else 'timeout'
@@ -185,12 +262,7 @@ class SparkApi(Api):
 
 
   def _execute(self, api, session, snippet_type, statement):
-    if not session or not self._check_session(session):
-      stored_session_info = self._get_session_info_from_user()
-      if stored_session_info and self._check_session(stored_session_info):
-        session = stored_session_info
-      else:
-        session = self.create_session(snippet_type)
+    session = self._get_healthy_session(session) or self.create_session(snippet_type)
 
     try:
       response = api.submit_statement(session['id'], statement)
@@ -200,8 +272,9 @@ class SparkApi(Api):
           'sync': False
       }
     except Exception as e:
-      message = force_unicode(str(e)).lower()
-      if re.search("session ('\d+' )?not found", message) or 'connection refused' in message or 'session is in state busy' in message:
+      message = str(e).lower()
+      session_not_found = 'not found' in message and self.SESSION_NOT_FOUND_RE.search(message)
+      if session_not_found or 'connection refused' in message or 'session is in state busy' in message:
         raise SessionExpired(e)
       else:
         raise e
@@ -216,12 +289,13 @@ class SparkApi(Api):
 
     try:
       response = api.fetch_data(session['id'], cell)
+      self._remember_fetch(session['id'], cell, response)
       return {
           'status': response['state'],
       }
     except Exception as e:
-      message = force_unicode(str(e)).lower()
-      if re.search("session ('\d+' )?not found", message):
+      message = str(e).lower()
+      if 'not found' in message and self.SESSION_NOT_FOUND_RE.search(message):
         raise SessionExpired(e)
       else:
         raise e
@@ -244,15 +318,18 @@ class SparkApi(Api):
     return response
 
 
-  def _fetch_result(self, api, session, cell):
-    try:
-      response = api.fetch_data(session['id'], cell)
-    except Exception as e:
-      message = force_unicode(str(e))
-      if re.search("session ('\d+' )?not found", message):
-        raise SessionExpired(e)
-      else:
-        raise PopupException(_(message))
+  def _fetch_result(self, api, session, cell, response=None):
+    if response is None:
+      response = self._pop_recent_fetch(session['id'], cell)
+    if response is None:
+      try:
+        response = api.fetch_data(session['id'], cell)
+      except Exception as e:
+        message = str(e)
+        if 'not found' in message and self.SESSION_NOT_FOUND_RE.search(message):
+          raise SessionExpired(e)
+        else:
+          raise PopupException(_(message))
 
     content = response['output']
 
@@ -302,6 +379,47 @@ class SparkApi(Api):
       raise QueryError(msg)
 
 
+  def _remember_fetch(self, session_id, cell, response):
+    '''
+    Keeps the response of a finished statement for FETCH_DATA_TTL seconds so that fetching its result
+    right after the status call does not ask Livy again. Results bigger than FETCH_DATA_MAX_BYTES are not kept.
+    '''
+    global _RECENT_FETCHES_BYTES
+
+    if response.get('state') != 'available':
+      return
+
+    size = len(json.dumps(response.get('output')))
+    if size > FETCH_DATA_MAX_BYTES:
+      return
+
+    key = (self._session_key, session_id, cell)
+    now = time.monotonic()
+    with _RECENT_FETCHES_LOCK:
+      if key in _RECENT_FETCHES:
+        _drop_recent_fetch(key)
+      # Entries are in insertion order, drop the oldest ones if results are never picked up
+      while _RECENT_FETCHES and (len(_RECENT_FETCHES) >= FETCH_DATA_MAX_ENTRIES or _RECENT_FETCHES_BYTES + size > FETCH_DATA_MAX_BYTES):
+        _drop_recent_fetch(next(iter(_RECENT_FETCHES)))
+      _RECENT_FETCHES[key] = (now, size, response)
+      _RECENT_FETCHES_BYTES += size
+
+    expiry = threading.Timer(FETCH_DATA_TTL, _expire_recent_fetch, args=(key, now))
+    expiry.daemon = True
+    expiry.start()
+
+
+  def _pop_recent_fetch(self, session_id, cell):
+    key = (self._session_key, session_id, cell)
+    with _RECENT_FETCHES_LOCK:
+      cached = _RECENT_FETCHES.get(key)
+      if cached is not None:
+        _drop_recent_fetch(key)
+
+    if cached is not None and time.monotonic() - cached[0] < FETCH_DATA_TTL:
+      return cached[2]
+
+
   def _handle_result_data(self, result, is_complex_type=False):
     """
     Parse the data from the 'result' dict based on whether it has complex datatypes or not.
@@ -370,8 +488,7 @@ class SparkApi(Api):
     try:
       response = api.cancel(session['id'])
     except Exception as e:
-      message = force_unicode(str(e)).lower()
-      LOG.debug(message)
+      LOG.debug('%s', e)
 
     return {'status': 0}
 
@@ -385,23 +502,33 @@ class SparkApi(Api):
     try:
       response = api.get_log(session['id'], startFrom=startFrom, size=size)
     except RestException as e:
-      message = force_unicode(str(e)).lower()
-      LOG.debug(message)
+      LOG.debug('%s', e)
 
     return response
   
 
   def _handle_session_health_check(self, session):
-    if not session or not self._check_session(session):
-      stored_session_info = self._get_session_info_from_user()
-      if stored_session_info and self._check_session(stored_session_info):
-        session = stored_session_info
-      else:
-        raise PopupException(_("Session error. Please create new session and try again."))
-    
+    session = self._get_healthy_session(session)
+    if not session:
+      raise PopupException(_("Session error. Please create new session and try again."))
+
     return session
 
 
+  def _get_healthy_session(self, session):
+    '''
+    Returns the session if it is healthy, else the healthy session stored for the user if any.
+    The stored session is not checked a second time when it is the session that was just rejected.
+    '''
+    if session and self._check_session(session):
+      return session
+
+    stored_session_info = self._get_session_info_from_user()
+    if stored_session_info and (not session or stored_session_info['id'] != session.get('id')) and \
+        self._check_session(stored_session_info):
+      return stored_session_info
+
+
   def close_statement(self, notebook, snippet): # Individual statements cannot be closed
     pass
 
@@ -410,6 +537,7 @@ class SparkApi(Api):
     api = self.get_api()
 
     if session['id'] is not None:
+      self._session_check_cache.pop(session['id'], None)
       try:
         api.close(session['id'])
         return {
@@ -418,6 +546,7 @@ class SparkApi(Api):
         }
       except RestException as e:
         if e.code == 404 or e.code == 500: # TODO remove the 500
+          self._api = None
           raise SessionExpired(e)
       finally:
         stored_session_info = self._get_session_info_from_user()
@@ -483,28 +612,28 @@ class SparkApi(Api):
     try:
       all_sessions = api.get_sessions()
     except Exception as e:
-      message = force_unicode(str(e)).lower()
-      LOG.debug(message)
+      LOG.debug('%s', e)
 
     if all_sessions:
       stored_session_info = self._get_session_info_from_user()
-      for session in all_sessions['sessions']:
-        if session['owner'] == self.user.username and session['id'] != stored_session_info['id'] and \
-          session['kind'] == session_type and session['state'] in ('idle', 'shutting_down', 'error', 'dead', 'killed'):
-          self.close_session(session)
+      unused_sessions = [
+        session for session in all_sessions['sessions']
+        if session['owner'] == self.user.username and session['id'] != stored_session_info['id'] and
+          session['kind'] == session_type and session['state'] in ('idle', 'shutting_down', 'error', 'dead', 'killed')
+      ]
 
+      if len(unused_sessions) == 1:
+        self.close_session(unused_sessions[0])
+      elif unused_sessions:
+        with ThreadPoolExecutor(max_workers=CLOSE_SESSIONS_MAX_WORKERS) as executor:
+          list(executor.map(self.close_session, unused_sessions))
 
-  def _check_status_and_fetch_result(self, api, session, execute_resp):
-    check_status = api.fetch_data(session['id'], execute_resp['id'])
 
-    count = 0
-    while check_status['state'] in ['running', 'waiting'] and count < 120:
-      check_status = api.fetch_data(session['id'], execute_resp['id'])
-      count += 1
-      time.sleep(1)
+  def _check_status_and_fetch_result(self, api, session, execute_resp):
+    check_status = _poll(lambda: api.fetch_data(session['id'], execute_resp['id']), ('running', 'waiting'))
 
     if check_status['state'] == 'available':
-      return self._fetch_result(api, session, execute_resp['id'])
+      return self._fetch_result(api, session, execute_resp['id'], response=check_status)
 
 
   def _show_databases(self, api, session, snippet_type):
@@ -516,10 +645,7 @@ class SparkApi(Api):
 
 
   def _show_tables(self, api, session, snippet_type, database):
-    use_db_execute = self._execute(api, session, snippet_type, 'USE %(database)s' % {'database': database})
-    use_db_resp = self._check_status_and_fetch_result(api, session, use_db_execute)
-
-    show_tables_execute = self._execute(api, session, snippet_type, 'SHOW TABLES')
+    show_tables_execute = self._execute(api, session, snippet_type, f'SHOW TABLES IN {database}')
     tables_list = self._check_status_and_fetch_result(api, session, show_tables_execute)
 
     if tables_list:
@@ -527,10 +653,7 @@ class SparkApi(Api):
 
 
   def _get_columns(self, api, session, snippet_type, database, table):
-    use_db_execute = self._execute(api, session, snippet_type, 'USE %(database)s' % {'database': database})
-    use_db_resp = self._check_status_and_fetch_result(api, session, use_db_execute)
-
-    describe_tables_execute = self._execute(api, session, snippet_type, 'DESCRIBE %(table)s' % {'table': table})
+    describe_tables_execute = self._execute(api, session, snippet_type, f'DESCRIBE {database}.{table}')
     columns_list = self._check_status_and_fetch_result(api, session, describe_tables_execute)
 
     if columns_list:
@@ -598,17 +721,7 @@ class SparkApi(Api):
     if operation == 'hello':
       statement = "SELECT 'Hello World!'"
     else:
-      column = '%(column)s' % {'column': column} if column else '*'
-      statement = textwrap.dedent('''\
-          SELECT %(column)s
-          FROM %(database)s.%(table)s
-          LIMIT %(limit)s
-          ''' % {
-            'database': database,
-            'table': table,
-            'column': column,
-            'limit': limit,
-        })
+      statement = f'SELECT {column or "*"}\nFROM {database}.{table}\nLIMIT {limit}\n'
 
     return statement
 
@@ -622,7 +735,7 @@ class SparkApi(Api):
     else:
       session = self.create_session(snippet.get('type'))
 
-    describe_query = 'DESCRIBE FORMATTED %(db)s.%(tb)s' % {'db': database, 'tb': table}
+    describe_query = f'DESCRIBE FORMATTED {database}.{table}'
     table_execute = self._execute(api, session, snippet.get('type'), describe_query)
     table_result = self._check_status_and_fetch_result(api, session, table_execute)
 
@@ -655,7 +768,7 @@ class SparkApi(Api):
     else:
       session = self.create_session(snippet.get('type'))
 
-    describe_query = 'DESCRIBE DATABASE EXTENDED %(db)s' % {'db': database}
+    describe_query = f'DESCRIBE DATABASE EXTENDED {database}'
     db_execute = self._execute(api, session, snippet.get('type'), describe_query)
     db_result = self._check_status_and_fetch_result(api, session, db_execute)
 
@@ -677,8 +790,6 @@ class SparkApi(Api):
 
 
   def _get_standalone_jobs(self, logs):
-    job_ids = set([])
-
     # Attempt to find Spark UI Host and Port from startup logs
     spark_ui_url = self.SPARK_UI_RE.search(logs)
 
@@ -689,9 +800,7 @@ class SparkApi(Api):
       spark_ui_url = spark_ui_url.group(1)
 
     # Standalone/Local mode runs on same host as Livy, attempt to find Job IDs in Spark log
-    for match in self.STANDALONE_JOB_RE.finditer(logs):
-      job_id = match.group(1)
-      job_ids.add(job_id)
+    job_ids = {match.group(1) for match in self.STANDALONE_JOB_RE.finditer(logs)}
 
     jobs = [{
       'name': job_id,
@@ -702,12 +811,8 @@ class SparkApi(Api):
 
 
   def _get_yarn_jobs(self, logs):
-    tracking_urls = set([])
-
     # YARN mode only outputs the tracking-proxy URL, not Job IDs
-    for match in self.YARN_JOB_RE.finditer(logs):
-      url = match.group(1)
-      tracking_urls.add(url)
+    tracking_urls = {match.group(1) for match in self.YARN_JOB_RE.finditer(logs)}
 
     jobs = [{
       'name': url.strip('/').split('/')[-1],  # application_id is the last token
@@ -718,35 +823,33 @@ class SparkApi(Api):
 
 
   def _is_yarn_mode(self):
-    return LIVY_SERVER_SESSION_KIND.get() == "yarn"
+    return _yarn_mode()
 
 
   def _get_session_info_from_user(self):
-    self.user = rewrite_user(self.user)
     session_key = self._get_session_key()
 
-    if self.user.profile.data.get(session_key):
-      return self.user.profile.data[session_key]
+    return self.user.profile.data.get(session_key) or None
 
 
   def _set_session_info_to_user(self, session_info):
-    self.user = rewrite_user(self.user)
     session_key = self._get_session_key()
 
+    # Avoid a profile write when the session did not change
+    if self.user.profile.data.get(session_key) == session_info:
+      return
+
     self.user.profile.update_data({session_key: session_info})
     self.user.profile.save()
 
 
   def _remove_session_info_from_user(self):
-    self.user = rewrite_user(self.user)
     session_key = self._get_session_key()
 
-    if self.user.profile.data.get(session_key):
-      json_data = self.user.profile.data
-      json_data.pop(session_key)
-      self.user.profile.json_data = json.dumps(json_data)
-    
-    self.user.profile.save()
+    data = self.user.profile.data
+    if data.pop(session_key, None):
+      self.user.profile.json_data = json.dumps(data)
+      self.user.profile.save()
 
 
 class SparkDescribeTable(Table):
@@ -979,3 +1082,7 @@ class SparkConfiguration(object):
       "value": [],
     }
   ]
+
+
+_DEFAULT_LIVY_PROPS = {p['name']: p['value'] for p in SparkConfiguration.PROPERTIES}
+_PROPERTY_TEMPLATES = tuple(SparkConfiguration.PROPERTIES)
@@ -23,6 +23,7 @@ from builtins import object
 from desktop.lib.django_test_util import make_logged_in_client
 from useradmin.models import User
 
+from notebook.connectors import spark_shell
 from notebook.connectors.spark_shell import SparkApi
 
 if sys.version_info[0] > 2:
@@ -46,6 +47,10 @@ class TestSparkApi(object):
       }
     self.api = SparkApi(self.user, self.interpreter)
 
+    # Do not share finished statement responses between tests
+    spark_shell._RECENT_FETCHES.clear()
+    spark_shell._RECENT_FETCHES_BYTES = 0
+
 
   def test_get_api(self):
     lang = 'pyspark'
@@ -55,6 +60,9 @@ class TestSparkApi(object):
     spark_api = self.api.get_api()
     assert spark_api.__class__.__name__ == 'LivyClient'
 
+    # The client is built once per SparkApi
+    assert self.api.get_api() is spark_api
+
 
   def test_get_livy_props_method(self):
     test_properties = [{
@@ -64,6 +72,52 @@ class TestSparkApi(object):
     props = self.api.get_livy_props('scala', test_properties)
     assert props['files'] == ['file_a', 'file_b', 'file_c']
 
+    # Empty entries are dropped
+    jars_props = self.api.get_livy_props('scala', [{'name': 'jars', 'value': 'a.jar,,b.jar,'}])
+    assert jars_props['jars'] == ['a.jar', 'b.jar']
+
+    # The last value of a duplicated conf key wins
+    conf_props = self.api.get_livy_props('scala', [{
+        'name': 'conf',
+        'value': [{'key': 'spark.a', 'value': '1'}, {'key': 'spark.a', 'value': '2'}, {'value': '3'}]
+      }])
+    assert conf_props['conf'] == {'spark.a': '2'}
+
+    # The defaults are shared between calls and stay untouched
+    assert self.api.get_livy_props('scala')['files'] == []
+    files_properties = [p for p in self.api.to_properties(props) if p['name'] == 'files']
+    assert files_properties[0]['value'] == ['file_a', 'file_b', 'file_c']
+    files_properties = [p for p in self.api.to_properties() if p['name'] == 'files']
+    assert files_properties[0]['value'] == []
+
+
+  def test_check_session(self):
+    self.api._api = Mock(
+      get_session=Mock(
+        return_value={'id': '1', 'state': 'idle'}
+      )
+    )
+
+    assert self.api._check_session({'id': '1'}) == {'id': '1', 'state': 'idle'}
+    assert self.api._check_session({'id': '1'}) == {'id': '1', 'state': 'idle'}
+    assert self.api._api.get_session.call_count == 1
+
+    # Unhealthy sessions are not returned
+    self.api._api.get_session.return_value = {'id': '2', 'state': 'dead'}
+    assert self.api._check_session({'id': '2'}) is None
+
+
+  def test_get_healthy_session(self):
+    self.api._check_session = Mock(return_value=None)
+    self.api._get_session_info_from_user = Mock(return_value={'id': '1'})
+
+    # The stored session is the rejected one, it is not checked again
+    assert self.api._get_healthy_session({'id': '1'}) is None
+    assert self.api._check_session.call_count == 1
+
+    self.api._check_session = Mock(side_effect=[None, {'id': '1', 'state': 'idle'}])
+    assert self.api._get_healthy_session({'id': '0'}) == {'id': '1'}
+
 
   def test_create_session_with_config(self):
     lang = 'pyspark'
@@ -154,6 +208,24 @@ class TestSparkApi(object):
       assert files_properties[0]['value'] == [], session['properties']
 
 
+  def test_session_info_to_user(self):
+    session_info = {'type': 'pyspark', 'id': '1', 'properties': []}
+    self.api._set_session_info_to_user(session_info)
+
+    with patch.object(self.api.user.profile, 'save') as save:
+      # Unchanged session info is not saved again
+      self.api._set_session_info_to_user(session_info)
+      save.assert_not_called()
+
+      self.api._remove_session_info_from_user()
+      save.assert_called_once()
+      assert self.api._get_session_info_from_user() is None
+
+      # Nothing to remove anymore
+      self.api._remove_session_info_from_user()
+      save.assert_called_once()
+
+
   def test_execute(self):
     with patch('notebook.connectors.spark_shell._get_snippet_session') as _get_snippet_session:
       with patch('notebook.connectors.spark_shell.get_spark_api') as get_spark_api:
@@ -174,6 +246,7 @@ class TestSparkApi(object):
         get_spark_api.return_value = Mock(
           submit_statement=Mock()
         )
+        self.api._api = None
         with pytest.raises(Exception):
           self.api.execute(notebook, snippet)
 
@@ -243,10 +316,56 @@ class TestSparkApi(object):
         get_spark_api.return_value = Mock(
           submit_statement=Mock()
         )
+        self.api._api = None
         with pytest.raises(Exception):
           self.api.check_status(notebook, snippet)
   
 
+  def test_fetch_result_after_check_status(self):
+    with patch('notebook.connectors.spark_shell._get_snippet_session') as _get_snippet_session:
+      notebook = Mock()
+      snippet = {
+        'result': {
+          'handle': {
+            'id': 'cell_1'
+          }
+        }
+      }
+      _get_snippet_session.return_value = {'id': '1'}
+
+      self.api._api = Mock(
+        fetch_data=Mock(
+          return_value={'state': 'available', 'output': {'status': 'ok', 'data': {'text/plain': 'Hello'}}}
+        )
+      )
+      self.api._handle_session_health_check = Mock(return_value={'id': '1'})
+
+      response = self.api.check_status(notebook, snippet)
+      assert response['status'] == 'available'
+
+      # The result comes from the response of the status call
+      response = self.api._fetch_result(self.api._api, {'id': '1'}, 'cell_1')
+      assert response['data'] == [['Hello']]
+      assert self.api._api.fetch_data.call_count == 1
+
+      # But only once
+      self.api._fetch_result(self.api._api, {'id': '1'}, 'cell_1')
+      assert self.api._api.fetch_data.call_count == 2
+
+      # Expired responses are dropped even if fetch_result is never called
+      self.api.check_status(notebook, snippet)
+      key, (timestamp, size, _) = next(iter(spark_shell._RECENT_FETCHES.items()))
+      assert spark_shell._RECENT_FETCHES_BYTES == size
+      spark_shell._expire_recent_fetch(key, timestamp)
+      assert not spark_shell._RECENT_FETCHES
+      assert spark_shell._RECENT_FETCHES_BYTES == 0
+
+      # Big results are not kept
+      with patch('notebook.connectors.spark_shell.FETCH_DATA_MAX_BYTES', 10):
+        self.api.check_status(notebook, snippet)
+      assert not spark_shell._RECENT_FETCHES
+
+
   def test_get_sample_data(self):
     snippet = Mock()
     self.api._execute = Mock(
@@ -291,6 +410,49 @@ class TestSparkApi(object):
     assert response['full_headers'] == 'test_meta'
   
 
+  def test_close_unused_sessions(self):
+    self.api._api = Mock(
+      get_sessions=Mock(
+        return_value={'sessions': [
+          {'id': '1', 'owner': 'hue_test', 'kind': 'pyspark', 'state': 'idle'},  # Current one
+          {'id': '2', 'owner': 'hue_test', 'kind': 'pyspark', 'state': 'dead'},
+          {'id': '3', 'owner': 'hue_test', 'kind': 'pyspark', 'state': 'idle'},
+          {'id': '4', 'owner': 'hue_test', 'kind': 'pyspark', 'state': 'busy'},
+          {'id': '5', 'owner': 'hue_test', 'kind': 'sql', 'state': 'idle'},
+          {'id': '6', 'owner': 'other_user', 'kind': 'pyspark', 'state': 'idle'},
+        ]}
+      )
+    )
+    self.api._get_session_info_from_user = Mock(return_value={'id': '1'})
+    self.api.close_session = Mock()
+
+    self.api._close_unused_sessions('pyspark')
+
+    closed_ids = sorted(args[0]['id'] for args, kwargs in self.api.close_session.call_args_list)
+    assert closed_ids == ['2', '3']
+
+
+  def test_check_status_and_fetch_result(self):
+    api = Mock(
+      fetch_data=Mock(
+        side_effect=[{'state': 'waiting'}, {'state': 'running'}, {'state': 'available'}]
+      )
+    )
+    self.api._fetch_result = Mock(
+      return_value={'data': 'test_data'}
+    )
+
+    with patch('notebook.connectors.spark_shell.time.sleep') as sleep:
+      response = self.api._check_status_and_fetch_result(api, {'id': '1'}, {'id': 'test_id'})
+
+    assert response == {'data': 'test_data'}
+    assert api.fetch_data.call_count == 3
+    # The last polled response is handed over instead of being fetched again
+    self.api._fetch_result.assert_called_once_with(api, {'id': '1'}, 'test_id', response={'state': 'available'})
+    # Polling backs off instead of waiting a full second between each status call
+    assert [args[0] for args, kwargs in sleep.call_args_list] == pytest.approx([0.05, 0.08])
+
+
   def test_get_select_query(self):
     # With operation as 'hello'
     response = self.api._get_select_query('test_db', 'test_table', 'test_column', 'hello')
@@ -305,6 +467,42 @@ class TestSparkApi(object):
     assert response == 'SELECT test_column\nFROM test_db.test_table\nLIMIT 100\n'
 
 
+  def test_autocomplete(self):
+    snippet = {'type': 'sparksql'}
+    self.api._api = Mock()
+    self.api.create_session = Mock(
+      return_value={
+        'id': 'test_id'
+      }
+    )
+    self.api._execute = Mock(
+      return_value='test_value'
+    )
+
+    # Tables are listed with a single qualified statement
+    self.api._check_status_and_fetch_result = Mock(
+      return_value={
+        'data': [['test_db', 'test_table', False]]
+      }
+    )
+    response = self.api.autocomplete(snippet, database='test_db')
+
+    assert response['tables_meta'] == ['test_table']
+    self.api._execute.assert_called_once_with(self.api._api, {'id': 'test_id'}, 'sparksql', 'SHOW TABLES IN test_db')
+
+    # Same for the columns
+    self.api._execute.reset_mock()
+    self.api._check_status_and_fetch_result = Mock(
+      return_value={
+        'data': [['test_column', 'string', 'test_comment']]
+      }
+    )
+    response = self.api.autocomplete(snippet, database='test_db', table='test_table')
+
+    assert response['columns'] == ['test_column']
+    self.api._execute.assert_called_once_with(self.api._api, {'id': 'test_id'}, 'sparksql', 'DESCRIBE test_db.test_table')
+
+
   def test_describe_database(self):
     notebook = Mock()
     snippet = Mock()